@@ -1,13 +1,12 @@
-import fire
+# fire, requests, tqdm and the download helpers are imported where they are used,
+# so short queries don't pay for importing them on every invocation
+import functools
 import sqlite3
-import pandas as pd
 import os
-import requests
 import sys
-import gzip
-import shutil
-from tqdm.autonotebook import tqdm
-from collections import OrderedDict 
+import io
+import weakref
+from collections import deque
 
 
 SRADB_URL = [
@@ -15,54 +14,348 @@ SRADB_URL = [
     "https://gbnci-abcc.ncifcrf.gov/backup/SRAmetadb.sqlite.gz",
 ]
 
+# name of the extracted database, both where download_sradb writes it and where __init__ looks first
+SRADB_FILE = "SRAmetadb.sqlite"
+
+# copy the decompressed database out in 4 MiB blocks; small blocks spend most of their time in python overhead
+EXTRACT_CHUNK_SIZE = 4 * 1024 * 1024
+
+# mirrors that accept range requests are fetched in parallel, in segments of this size
+DOWNLOAD_SEGMENT_SIZE = 8 * 1024 * 1024
+DOWNLOAD_WORKERS_PER_URL = 8
+
+# a single-stream download is read ahead on a background thread, up to this many 1 MiB reads
+DOWNLOAD_READ_SIZE = 1024 * 1024
+DOWNLOAD_READ_AHEAD = 32
+
+# (connect, read) timeouts in seconds for every download request, so a stalled mirror raises and the
+# next one is tried instead of blocking the download forever
+DOWNLOAD_TIMEOUT = (10, 60)
+
+# (index name, table, column) for the columns the query methods filter on
+SRA_INDEXES = [('idx_sra_exp_acc', 'sra', 'experiment_accession'),
+               ('idx_sra_sub_acc', 'sra', 'submission_accession'),
+               ('idx_exp_sub_acc', 'experiment', 'submission_accession'),
+               ('idx_sample_sub_acc', 'sample', 'submission_accession'),
+               ('idx_exp_study_acc', 'experiment', 'study_accession'),
+               ]
+
+# experiment and study columns searched by terms
+TERMS_COLUMNS = ['experiment_title', 'study_name', 'design_description', 'sample_name', 'library_strategy',
+                 'library_construction_protocol', 'platform', 'instrument_model', 'platform_parameters', 'study_abstract']
+
+# the searched columns joined into one text value, so each term costs a single LIKE per row. The columns are
+# separated by char(31), the same byte as MATCH_ALL_SEP, which no term contains, so a term like
+# 'Illumina HiSeq' can't match across two columns
+TERMS_EXPR = " || char(31) || ".join("ifnull({}, '')".format(c) for c in TERMS_COLUMNS)
+
+# the condition for a single term; a search for n terms is n of these joined by AND
+TERMS_LIKE = '(' + TERMS_EXPR + ") LIKE ? ESCAPE '\\'"
+
+# searches with more terms than this use one match_all() call per row instead of a LIKE per term
+MATCH_ALL_MIN_TERMS = 4
+
+# separates the terms packed into the single match_all() parameter
+MATCH_ALL_SEP = '\x1f'
+
+# accessions bound per IN (...) query, kept under SQLite's default limit of 999 variables
+MAX_SQL_VARIABLES = 900
+
+# rows fetched per batch when printing terms results
+TERMS_CHUNK_SIZE = 100000
+
+# term groups ORed into a single search, so a terms file is searched in a few passes over sra
+TERMS_BATCH_GROUPS = 100
+
+# seconds a connection waits for another process's lock on a shared database before giving up
+SQLITE_BUSY_TIMEOUT = 30
+
+# per-connection settings for a large, read-mostly database: a 256 MiB page cache, in-memory temp tables
+# and memory-mapped reads. The journal mode is left alone, it is stored in the database file and WAL
+# does not work on network filesystems such as the NFS home directories of a cluster
+SQLITE_PRAGMAS = ['PRAGMA cache_size=-262144;',
+                  'PRAGMA temp_store=MEMORY;',
+                  'PRAGMA mmap_size=30000000000;',
+                  ]
+
+# bump when SRA_INDEXES changes so existing databases pick up the new indexes
+INDEX_VERSION = 1
+
 SQL_dict = {'all_sm_lcp': 'SELECT experiment_accession FROM sra WHERE library_construction_protocol IS NOT NULL;',
-            'all_sm_lcp_kw': 'SELECT experiment_accession FROM experiment WHERE (study_accession=?) AND (library_construction_protocol ' +
-                             'IS NOT NULL);',
+            'all_sm_lcp_kw': 'SELECT DISTINCT experiment_accession FROM experiment WHERE (library_construction_protocol ' +
+                             'IS NOT NULL) AND study_accession IN (SELECT study_accession FROM sra WHERE {});',
+            'analyze': 'ANALYZE;',
+            'begin': 'BEGIN;',
+            'commit': 'COMMIT;',
             'count_lcp': 'SELECT count(library_construction_protocol) FROM experiment WHERE library_construction_protocol ' + 
                           'like ? OR library_construction_protocol like ?;',
+            'create_index': 'CREATE INDEX IF NOT EXISTS {} ON {}({});',
+            'create_fts': "CREATE VIRTUAL TABLE IF NOT EXISTS sra_fts USING fts5({}, content='sra', " +
+                          "tokenize='porter unicode61');",
             'create_params': 'CREATE TABLE IF NOT EXISTS params (accession TEXT PRIMARY KEY, fragmentation TEXT, adapter_ligation TEXT, ' +
-                             'enrichment TEXT);',
-            'keyword_match': 'SELECT experiment_accession FROM sra WHERE (experiment_accession=?) AND (library_construction_protocol ' +
-                             'LIKE ? OR study_abstract LIKE ?);',
+                             'enrichment TEXT, keywords TEXT);',
+            'params_add_keywords': 'ALTER TABLE params ADD COLUMN keywords TEXT;',
+            'params_columns': "SELECT name FROM pragma_table_info('params');",
+            'params_save_keywords': 'INSERT INTO params (accession, keywords) VALUES (?, ?) ' +
+                                    'ON CONFLICT(accession) DO UPDATE SET keywords=excluded.keywords;',
+            'find_table': "SELECT name FROM sqlite_master WHERE type='table' AND name=?;",
+            'get_user_version': 'PRAGMA user_version;',
+            'km_drop_temp': 'DROP TABLE IF EXISTS temp.km_experiments;',
+            'km_drop_kw_temp': 'DROP TABLE IF EXISTS temp.km_keywords;',
             'km_create_temp': 'CREATE TEMP TABLE km_experiments AS SELECT * FROM sra WHERE 0;',
             'km_insert_temp': 'INSERT INTO km_experiments SELECT * FROM sra WHERE experiment_accession=?;',
+            'km_create_kw_temp': 'CREATE TEMP TABLE km_keywords (keyword TEXT);',
+            'km_insert_kw_temp': 'INSERT INTO km_keywords VALUES (?);',
+            'km_match': 'SELECT DISTINCT e.experiment_accession, k.keyword FROM km_experiments e JOIN km_keywords k ON ' +
+                        "(e.library_construction_protocol LIKE '% ' || k.keyword || ' %' OR " +
+                        "e.study_abstract LIKE '% ' || k.keyword || ' %') ORDER BY e.rowid, k.rowid;",
+            'optimize': 'PRAGMA optimize;',
+            'rebuild_fts': "INSERT INTO sra_fts(sra_fts) VALUES('rebuild');",
+            'rollback': 'ROLLBACK;',
             'meta_info': 'SELECT * FROM metaInfo;',
             'list_tables': 'SELECT name FROM sqlite_master WHERE type="table";',
-            'srx_sa_lcp': 'SELECT {} FROM sra WHERE experiment_accession=?;'
+            'set_user_version': 'PRAGMA user_version={};',
+            'srx_sa_lcp': 'SELECT experiment_accession, {} FROM sra WHERE experiment_accession IN ({});',
+            'terms': 'SELECT DISTINCT {} FROM sra WHERE {};',
+            'terms_fts': 'rowid IN (SELECT rowid FROM sra_fts WHERE sra_fts MATCH ?)'
             }
 
 
+class _RangeReader(io.RawIOBase):
+    """
+    Read-only file object over a remote file, downloaded as concurrent HTTP range requests spread across \n
+    mirrors. Segments are fetched ahead of the reader but handed out strictly in order, so the stream can \n
+    be decompressed as it arrives. Class name is preceded by underscore to hide from user.
+    """
+    def __init__(self, session, urls, size):
+        from concurrent.futures import ThreadPoolExecutor
+
+        self.session = session
+        self.urls = urls
+        self.size = size
+        workers = len(urls) * DOWNLOAD_WORKERS_PER_URL
+        self.pool = ThreadPoolExecutor(max_workers=workers)
+        self.pending = deque()
+        self.offset = 0
+        self.segment = 0
+        self.buffer = memoryview(b'')
+        # keep two segments queued per worker so no connection sits idle between requests
+        for _ in range(2 * workers):
+            self._submit()
+
+    def _submit(self):
+        if self.offset >= self.size:
+            return
+        lo = self.offset
+        hi = min(lo + DOWNLOAD_SEGMENT_SIZE, self.size) - 1
+        self.pending.append(self.pool.submit(self._fetch, self.segment % len(self.urls), lo, hi))
+        self.offset = hi + 1
+        self.segment += 1
+
+    def _fetch(self, first, lo, hi):
+        import requests
+
+        # start with the assigned mirror, move on to the others if it fails
+        for i in range(len(self.urls)):
+            url = self.urls[(first + i) % len(self.urls)]
+            try:
+                # streamed, so a mirror that answers with the whole file is caught before its body is read
+                with self.session.get(url, headers={'Range': 'bytes={}-{}'.format(lo, hi)}, stream=True,
+                                      timeout=DOWNLOAD_TIMEOUT) as r:
+                    r.raise_for_status()
+                    content_range = r.headers.get('Content-Range', '').split('/')[0]
+                    if r.status_code != 206 or content_range != 'bytes {}-{}'.format(lo, hi):
+                        raise IOError('{} did not honour the range request for bytes {}-{}'.format(url, lo, hi))
+                    content = r.content
+                if len(content) != hi - lo + 1:
+                    raise IOError('{} returned a short range for bytes {}-{}'.format(url, lo, hi))
+                return content
+            except (requests.RequestException, IOError) as e:
+                error = e
+        raise error
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        while not self.buffer:
+            if not self.pending:
+                return 0
+            self.buffer = memoryview(self.pending.popleft().result())
+            self._submit()
+        n = min(len(b), len(self.buffer))
+        b[:n] = self.buffer[:n]
+        self.buffer = self.buffer[n:]
+        return n
+
+    def close(self):
+        for future in self.pending:
+            future.cancel()
+        self.pool.shutdown(wait=False)
+        super().close()
+
+
+class _PrefetchReader(io.RawIOBase):
+    """
+    Read-only file object that reads ahead from another file object on a background thread, so the \n
+    network keeps receiving while the previous blocks are decompressed. Class name is preceded by \n
+    underscore to hide from user.
+    """
+    def __init__(self, raw):
+        import queue
+        import threading
+
+        self.chunks = queue.Queue(maxsize=DOWNLOAD_READ_AHEAD)
+        self.buffer = memoryview(b'')
+        self.eof = False
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self._pump, args=(raw,), daemon=True)
+        self.thread.start()
+
+    def _pump(self, raw):
+        try:
+            # stop reading as soon as the reader has gone away, the response is about to be closed
+            while not self.stopped.is_set():
+                chunk = raw.read(DOWNLOAD_READ_SIZE)
+                self._put(chunk)
+                if not chunk:
+                    break
+        except Exception as e:
+            # hand the error to the reader
+            self._put(e)
+
+    def _put(self, item):
+        import queue
+
+        # stop waiting for room once the reader has gone away
+        while not self.stopped.is_set():
+            try:
+                self.chunks.put(item, timeout=1)
+                return
+            except queue.Full:
+                pass
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        while not self.buffer:
+            if self.eof:
+                return 0
+            item = self.chunks.get()
+            if isinstance(item, Exception):
+                raise item
+            if not item:
+                self.eof = True
+                return 0
+            self.buffer = memoryview(item)
+        n = min(len(b), len(self.buffer))
+        b[:n] = self.buffer[:n]
+        self.buffer = self.buffer[n:]
+        return n
+
+    def close(self):
+        self.stopped.set()
+        # let the current read finish before the caller closes the response underneath it
+        self.thread.join(timeout=5)
+        super().close()
+
+
+# database paths found so far in this process, keyed by working directory
+_DB_PATHS = {}
+
+
+def _resolve_db_path():
+    """
+    Look for the database in the current directory, then in .databasepath. A path that exists is \n
+    remembered, so constructing SRAMetadataX again in the same process skips the lookups.
+    """
+    cwd = os.getcwd()
+    if cwd in _DB_PATHS:
+        return _DB_PATHS[cwd]
+
+    path = None
+    # First check for database file in current directory
+    if os.path.exists(os.path.join(cwd, SRADB_FILE)):
+        path = os.path.join(cwd, SRADB_FILE)
+    elif os.path.exists('.databasepath'):
+        # strip the trailing newline, otherwise the stored path never matches a file
+        with open('.databasepath', 'r') as f:
+            path = f.read().strip()
+
+    # misses are not remembered, the database may be downloaded or pointed to later
+    if path is not None and os.path.isfile(path):
+        _DB_PATHS[cwd] = path
+    return path
+
+
+def _close_db(db):
+    """
+    Close a database connection, first letting SQLite refresh any planner statistics that the \n
+    session's queries showed to be stale.
+    """
+    try:
+        db.execute(SQL_dict['optimize'])
+    except sqlite3.Error:
+        # e.g. another job holds the lock; the statistics can wait for the next session
+        pass
+    finally:
+        db.close()
+
+
+@functools.lru_cache(maxsize=64)
+def _match_all_terms(terms):
+    return terms.lower().split(MATCH_ALL_SEP)
+
+
+def _match_all(text, terms):
+    """
+    SQLite function match_all(text, terms): 1 if every term packed into terms occurs in text. \n
+    Case-insensitive like LIKE, and the text is lowered once per row however many terms there are.
+    """
+    text = text.lower()
+    return all(t in text for t in _match_all_terms(terms))
+
+
 class SRAMetadataX(object):
-    def __init__(self):
+    # shared instance handed out by open()
+    _instance = None
+
+    def __init__(self, sqlite_file: str = None, auto_download: bool = False):
         """Initialize SRAdb.
         Parameters
         ----------
         self: string
                     Extract metadata from the SRAdb package. Output SRRs to a text file and use the SRA toolkit to download.
         sqlite_file: string
-                    Path to unzipped SRAmetadb.sqlite file
-        """
-        # First check for database file in current directory
-        if not os.path.exists(os.path.join(os.getcwd(), "SRAmetadb.sqlite")):   
-            if os.path.exists('.databasepath'):
-                with open('.databasepath', 'r') as f:
-                    for line in f:
-                        self.sqlite_file = line
+                    OPTIONAL: Path to unzipped SRAmetadb.sqlite file. Defaults to the SRAMETADB_PATH environment \n
+                    variable, then SRAmetadb.sqlite in the current directory, then the path stored in .databasepath
+        auto_download: bool
+                    OPTIONAL: download SRAmetadb.sqlite without prompting if no database file is found
+        """
+        # created on the first download, see _http_session
+        self._session = None
+
+        # an explicit path wins, then the environment
+        self.sqlite_file = sqlite_file or os.environ.get('SRAMETADB_PATH')
+        if self.sqlite_file is None:
+            self.sqlite_file = _resolve_db_path()
+
+        # only fall back to the prompts when there is no file to open
+        if self.sqlite_file is not None and os.path.isfile(self.sqlite_file):
+            self.db = self._connect(self.sqlite_file)
+        elif auto_download:
+            self.download_sradb()
+        elif not sys.stdin.isatty():
+            # nobody is there to answer the prompts, fail instead of waiting on stdin
+            raise RuntimeError(
+                "SRAmetadb sqlite file not found. Pass --sqlite_file, set SRAMETADB_PATH or pass --auto_download"
+            )
         else:
-            self.sqlite_file = os.path.join(os.getcwd(), "SRAmetadb.sqlite")
-
-        try:
-            self.db = sqlite3.connect(
-                "file:{}?mode=rw".format(self.sqlite_file), uri=True)
-        except:
             value = input(
                 "SRAmetadb sqlite file not found. Download file? Enter [y/n]:\n")
             if value == 'y':
                 self.download_sradb()
-                self.sqlite_file = os.path.join(
-                    os.getcwd(), "SRAmetadb.sqlite")
-                self.db = sqlite3.connect(
-                    "file:{}?mode=rw".format(self.sqlite_file), uri=True)
             else:
                 value = input(
                     "Enter the path to your SRAmetadb.sqlite file (enter [n] to exit):\n")
@@ -70,61 +363,167 @@ class SRAMetadataX(object):
                     print('Exiting...')
                     exit()
                 else:
-                    self.sqlite_file = value
-                    self.db = sqlite3.connect(
-                        "file:{}?mode=rw".format(self.sqlite_file), uri=True)
+                    self.sqlite_file = value.strip()
+                    self.db = self._connect(self.sqlite_file)
                     # store the given database path for future use
                     with open('.databasepath', 'w') as f:
-                        f.write(value)
+                        f.write(self.sqlite_file)
 
         self.cursor = self.db.cursor()
+        self.ensure_indexes()
+        # closes the connection when the instance is garbage collected or at exit, without keeping it alive
+        self._finalizer = weakref.finalize(self, _close_db, self.db)
 
 
-    def all_sm_lcp(self, terms = 'none'):
+    @classmethod
+    def open(cls, sqlite_file: str = None, auto_download: bool = False):
+        """
+        Return one SRAMetadataX shared by the whole process, connecting on first use. Python code that \n
+        runs many queries can call this instead of reopening the database for each one.
+        """
+        if cls._instance is None or cls._instance.db is None:
+            cls._instance = cls(sqlite_file, auto_download)
+        return cls._instance
+
+
+    def all_sm_lcp(self, terms = 'none', fts: bool = False):
         """
         List all SRA experiments that contain sample manipulation/library construction protocol data.\n
         Alternatively, search for experiments that contain sm/lcp data and a term or set of terms.
         :param terms: a term or list of terms that submissions need to contain. Alternatively, \n
         enter the path to a text file of term groups to search for.
+        :param fts: OPTIONAL: match the terms as whole words in the full text index, see terms.
         :return: experiment accession numbers
         """
         results_final = []
         if terms == 'none':
             results = self.cursor.execute(SQL_dict['all_sm_lcp']).fetchall()
             return results
+        elif fts and not self._has_fts():
+            print("Error: no full text index found, run 'cli.py ensure_fts' first or search without --fts")
+            return
         else:
-            srps = self.terms(terms, 'study_accession, run_accession', print_out = False)
-            srps_set = set(srps)
-            unique_srps = list(srps_set)
-            for srp in unique_srps:
-                results = self.cursor.execute(SQL_dict['all_sm_lcp_kw'], (srp[0], )).fetchall()
-                for r in results:
-                    results_final.append(r[0])
-            results_final = list(OrderedDict.fromkeys(results_final))
+            # the terms search runs as a subquery, so SQLite finds the studies and their experiments in one statement
+            seen = set()
+            for conditions, params in self._term_batches(self._term_groups(terms), fts):
+                for r in self.cursor.execute(SQL_dict['all_sm_lcp_kw'].format(conditions), params):
+                    # batches of term groups can overlap
+                    if r[0] not in seen:
+                        seen.add(r[0])
+                        results_final.append(r[0])
             return results_final
 
 
-    def _download(self, url, file_path):
+    def close(self):
+        """
+        Close the database connection, first letting SQLite refresh any planner statistics that \n
+        this session's queries showed to be stale. Called automatically when the instance is garbage \n
+        collected or the CLI exits.
+        """
+        if self.db is None:
+            return
+        self._finalizer()
+        self.db = None
+
+
+    def _connect(self, sqlite_file):
+        """
+        Connect helper function. Method name is preceded by underscore to hide from user.
+        """
+        # autocommit: the CLI mostly reads, so skip the implicit BEGIN/COMMIT around every statement.
+        # a larger statement cache keeps the per-shape terms and IN (...) queries prepared between calls
+        db = sqlite3.connect("file:{}?mode=rw".format(sqlite_file), uri=True, check_same_thread=False,
+                             isolation_level=None, cached_statements=256, timeout=SQLITE_BUSY_TIMEOUT)
+        for pragma in SQLITE_PRAGMAS:
+            db.execute(pragma)
+        db.create_function('match_all', 2, _match_all, deterministic=True)
+        return db
+
+
+    def _download(self, urls, file_path):
         """
         Download helper function. Method name is preceded by underscore to hide from user.
+        The gzipped stream is decompressed as it arrives so the .gz archive never touches the disk.
+        Mirrors that support range requests are downloaded from in parallel, otherwise the first url is \n
+        streamed over a single connection.
         """
+        session = self._http_session()
+        mirrors, size = self._range_mirrors(urls)
         with open(file_path, "wb") as f:
             print("Downloading {}".format(file_path))
-            with requests.get(url, stream=True) as r:
+            if mirrors:
+                with _RangeReader(session, mirrors, size) as raw:
+                    self._extract(raw, size, f)
+            else:
+                with session.get(urls[0], stream=True, timeout=DOWNLOAD_TIMEOUT) as r:
+                    r.raise_for_status()
+                    # leave the gzip framing intact, GzipFile does the decompression
+                    r.raw.decode_content = False
+                    with _PrefetchReader(r.raw) as raw:
+                        self._extract(raw, int(r.headers['Content-Length']), f)
+
+
+    def _extract(self, raw, size, f):
+        """
+        Extract helper function. Method name is preceded by underscore to hide from user.
+        """
+        import gzip
+        import shutil
+        from tqdm import tqdm
+
+        with tqdm.wrapattr(raw, "read", total=size) as raw:
+            with gzip.GzipFile(fileobj=raw) as gz:
+                # large blocks keep the per-read overhead small next to the inflate work
+                shutil.copyfileobj(gz, f, length=EXTRACT_CHUNK_SIZE)
+
+
+    def _http_session(self):
+        """
+        Session helper function. Method name is preceded by underscore to hide from user.
+        One pooled session keeps connections to the download mirrors alive between requests.
+        """
+        if self._session is None:
+            import requests
+
+            self._session = requests.Session()
+            adapter = requests.adapters.HTTPAdapter(pool_connections=len(SRADB_URL),
+                                                    pool_maxsize=DOWNLOAD_WORKERS_PER_URL)
+            self._session.mount('http://', adapter)
+            self._session.mount('https://', adapter)
+        return self._session
+
+
+    def _range_mirrors(self, urls):
+        """
+        Mirror helper function. Method name is preceded by underscore to hide from user.
+        Returns the urls that accept range requests and serve the same file as the first of them, \n
+        along with the file size.
+        """
+        import requests
+
+        mirrors = []
+        size = None
+        for url in urls:
+            try:
+                r = self._http_session().head(url, allow_redirects=True, timeout=DOWNLOAD_TIMEOUT)
                 r.raise_for_status()
-                pbar = tqdm(total=int(r.headers['Content-Length']))
-                for chunk in r.iter_content(chunk_size=8192):
-                    if chunk:  # filter out keep-alive new chunks
-                        f.write(chunk)
-                        pbar.update(len(chunk))
+            except requests.RequestException:
+                continue
+            if r.headers.get('Accept-Ranges') != 'bytes' or 'Content-Length' not in r.headers:
+                continue
+            if size is None:
+                size = int(r.headers['Content-Length'])
+            # a mirror with a different size holds a different release of the database
+            if int(r.headers['Content-Length']) == size:
+                mirrors.append(r.url)
+        return mirrors, size
 
 
     def download_sradb(self):
         """
         Download SRAdb.sqlite file.
         """
-        dl_path = os.path.join(os.getcwd(), "SRAmetadb.sqlite.gz")
-        dl_path_unzipped = dl_path.rstrip(".gz")
+        dl_path = os.path.join(os.getcwd(), SRADB_FILE)
 
         if os.path.isfile(dl_path):
             raise RuntimeError(
@@ -132,43 +531,101 @@ class SRAMetadataX(object):
                     dl_path
                 )
             )
-        if os.path.isfile(dl_path_unzipped):
-            raise RuntimeError(
-                "{} already exists!".format(
-                    dl_path_unzipped
-                )
-            )
 
+        # decompress under a temporary name, so an interrupted download never sits where __init__ looks
+        part_path = dl_path + '.part'
         try:
-            self._download(SRADB_URL[0], dl_path)
-        except Exception as e:
-            # Try NCBI
-            sys.stderr.write(
-                "Could not use AWS s3 {}.\nException: {}.\nTrying NCBI...\n".format(
-                    SRADB_URL[0], e
-                )
-            )
             try:
-                self._download(SRADB_URL[1], dl_path)
+                self._download(SRADB_URL, part_path)
             except Exception as e:
+                # Try NCBI
                 sys.stderr.write(
-                    "Could not use NCBI {}.\nException: {}.\nPlease download the SQlite file via wget...\n".format(
+                    "Could not use AWS s3 {}.\nException: {}.\nTrying NCBI...\n".format(
                         SRADB_URL[0], e
                     )
                 )
-
-        print("Extracting {} ...".format(dl_path))
-
-        with gzip.open(dl_path, "rb") as f_in:
-            with open(dl_path_unzipped, "wb") as f_out:
-                shutil.copyfileobj(f_in, f_out)
+                try:
+                    self._download(SRADB_URL[1:], part_path)
+                except Exception as e:
+                    sys.stderr.write(
+                        "Could not use NCBI {}.\nException: {}.\nPlease download the SQlite file via wget...\n".format(
+                            SRADB_URL[1], e
+                        )
+                    )
+                    raise
+            # GzipFile raises on a truncated stream, so only a complete database gets here
+            os.replace(part_path, dl_path)
+        finally:
+            # don't leave a partial database behind, also on Ctrl-C
+            if os.path.isfile(part_path):
+                os.remove(part_path)
 
         print("SRAmetadb file download complete!")
+        self.sqlite_file = dl_path
+        self.db = self._connect(self.sqlite_file)
+        self.cursor = self.db.cursor()
         metadata = self.cursor.execute(SQL_dict['meta_info']).fetchall()
         print("SRAdb file Metadata:")
         print(metadata)
 
 
+    def ensure_indexes(self):
+        """
+        Create indexes on the accession columns used by the query methods. SRAdb ships without them, \n
+        so every lookup would otherwise scan the full table. Runs once per database; progress is tracked \n
+        with PRAGMA user_version. A database that can't be written to, because it is read-only or another \n
+        process is indexing it, is used without the indexes.
+        """
+        if self.cursor.execute(SQL_dict['get_user_version']).fetchone()[0] >= INDEX_VERSION:
+            return
+
+        # stderr, so the banner doesn't end up in redirected accession lists
+        sys.stderr.write('Indexing SRAdb, this only happens once and may take a few minutes...\n')
+        try:
+            self.cursor.execute(SQL_dict['begin'])
+            for index, table, column in SRA_INDEXES:
+                self.cursor.execute(SQL_dict['create_index'].format(index, table, column))
+            # collect statistics so the query planner actually chooses the new indexes
+            self.cursor.execute(SQL_dict['analyze'])
+            self.cursor.execute(SQL_dict['set_user_version'].format(INDEX_VERSION))
+            self.cursor.execute(SQL_dict['commit'])
+        except sqlite3.OperationalError as e:
+            if self.db.in_transaction:
+                self.cursor.execute(SQL_dict['rollback'])
+            sys.stderr.write('Could not index SRAdb: {}. Continuing without indexes.\n'.format(e))
+
+
+    def ensure_fts(self):
+        """
+        Build a full text index over the columns searched by terms. terms and all_sm_lcp called with --fts \n
+        look up whole words in the index instead of scanning every row with LIKE, which changes what \n
+        matches: 'NA1287' no longer finds NA12878, and words are compared by stem, so 'sequencing' also \n
+        finds 'sequenced'. Building the index over the full SRAdb takes a while and only has to be done once. \n
+        Requires an SQLite built with FTS5.
+        """
+        if self._has_fts():
+            print('Full text index already exists')
+            return
+
+        sys.stderr.write('Building full text index, this only happens once and may take a while...\n')
+        # one transaction, so an interrupted build doesn't leave behind an empty index that finds nothing
+        self.cursor.execute(SQL_dict['begin'])
+        try:
+            self.cursor.execute(SQL_dict['create_fts'].format(', '.join(TERMS_COLUMNS)))
+            self.cursor.execute(SQL_dict['rebuild_fts'])
+        except BaseException:
+            self.cursor.execute(SQL_dict['rollback'])
+            raise
+        self.cursor.execute(SQL_dict['commit'])
+
+
+    def _has_fts(self):
+        """
+        Full text index helper function. Method name is preceded by underscore to hide from user.
+        """
+        return self.cursor.execute(SQL_dict['find_table'], ('sra_fts',)).fetchone() is not None
+
+
     def keyword_match(self, experiments_file, keyword_file = 'oogabooga', save: str = 'true'):
         """
         Search the metadata of a given list of experiments for matching keywords. Use this method \n
@@ -182,36 +639,53 @@ class SRAMetadataX(object):
         """
         #create the params table if it does not exist
         self.cursor.execute(SQL_dict['create_params'])
+        # params tables created before keywords were stored lack the column
+        if 'keywords' not in {c for c, in self.cursor.execute(SQL_dict['params_columns'])}:
+            self.cursor.execute(SQL_dict['params_add_keywords'])
+
+        if not os.path.isfile(str(keyword_file)):
+            print('Keyword file {} not found'.format(keyword_file))
+            return
 
+        # experiments in file order, each mapped to the keywords found in its metadata
         with open(experiments_file, 'r') as f:
-            #create smaller table of desired experiments from sra table to speed up execution
-            self.cursor.execute(SQL_dict['km_create_temp'])
-            for accession in f:
-                accession = accession.rstrip("\n")
-                self.cursor.execute(SQL_dict['km_insert_temp'], (accession,))
-                #print(self.query('SELECT count(experiment_accession) FROM km_experiments;'))
-
-        # with open(keyword_file, 'r') as kw:
-        #     for submission in s:
-        #         result_string = submission
-        #         sys.stdout.write(
-        #             "Parsing {}.. this may take a while depending on the number of keywords in your file".format(submission))
-        #         for line in kw:
-        #             for keyword in line.split():
-        #                 #print(keyword)
-        #                 results = self.cursor.execute(
-        #                     SQL_dict['keyword_match'], (submission, '% ' + keyword + ' %', '% ' + keyword + ' %')).fetchall()
-        #                 if results:
-        #                     result_string += ' ' + keyword
-                
-        #             print(result_string)
+            matches = {accession.rstrip("\n"): [] for accession in f}
+        with open(keyword_file, 'r') as kw:
+            keywords = dict.fromkeys(keyword for line in kw for keyword in line.split())
+
+        # fill both temp tables in one transaction rather than committing after every row
+        self.cursor.execute(SQL_dict['begin'])
+        # temp tables from an earlier call on this connection (e.g. from the shell) are replaced
+        self.cursor.execute(SQL_dict['km_drop_temp'])
+        self.cursor.execute(SQL_dict['km_drop_kw_temp'])
+        #create smaller table of desired experiments from sra table to speed up execution
+        self.cursor.execute(SQL_dict['km_create_temp'])
+        self.cursor.executemany(SQL_dict['km_insert_temp'], ((accession,) for accession in matches))
+        # load every keyword into a temp table and match them all in one pass over the experiments
+        self.cursor.execute(SQL_dict['km_create_kw_temp'])
+        self.cursor.executemany(SQL_dict['km_insert_kw_temp'], ((keyword,) for keyword in keywords))
+        self.cursor.execute(SQL_dict['commit'])
+
+        # stderr, so the banner doesn't end up in redirected results
+        sys.stderr.write("Parsing experiments... this may take a while depending on the number of keywords in your file\n")
+        for accession, keyword in self.cursor.execute(SQL_dict['km_match']):
+            matches[accession].append(keyword)
+
+        if save != 'ns':
+            # one transaction and one prepared statement for every matched experiment
+            self.cursor.execute(SQL_dict['begin'])
+            self.cursor.executemany(SQL_dict['params_save_keywords'],
+                                    ((accession, ' '.join(keywords)) for accession, keywords in matches.items() if keywords))
+            self.cursor.execute(SQL_dict['commit'])
+
+        sys.stdout.writelines(' '.join([accession] + keywords) + '\n' for accession, keywords in matches.items())
 
 
     def query(self, sql_query: str = 'none'):
         """
         Run custom SQL query.
         :param sql_query: SQL query string
-        :return: query results formatted as pandas dataframe
+        :return: query results as a list of row tuples
         """
         if sql_query != 'none':
             results = self.cursor.execute(sql_query).fetchall()
@@ -223,6 +697,37 @@ class SRAMetadataX(object):
             print("Please enter a valid query. Run 'query --help' for more info.")
 
 
+    def shell(self):
+        """
+        Run several commands against one open database connection. Reads one command per line from \n
+        stdin, ex: 'srx_sa_lcp SRX123 lcp', so scripts can pipe in a batch of commands instead of \n
+        starting the CLI and reopening the database for each one. Enter [exit] to quit.
+        """
+        import fire
+
+        prompt = 'SRAMetadataX> ' if sys.stdin.isatty() else ''
+        while True:
+            try:
+                command = input(prompt).strip()
+            except EOFError:
+                break
+            if not command:
+                continue
+            if command == 'exit':
+                break
+            try:
+                fire.Fire(self, command=command)
+            except SystemExit:
+                # fire exits after printing usage for a bad command, keep the session alive
+                pass
+            except Exception as e:
+                # report the failed command and go on with the rest of the batch
+                sys.stderr.write('Error: {}: {}\n'.format(command, e))
+                # a command that failed mid-transaction, e.g. keyword_match, must not leave it open
+                if self.db.in_transaction:
+                    self.cursor.execute(SQL_dict['rollback'])
+
+
     def srx_sa_lcp(self, srx, sa_lcp: str = 'sa_lcp'):
         """
         Extracts study abstract and/or library construction protocol data for an SRA experiment or list of \n
@@ -250,14 +755,22 @@ class SRAMetadataX(object):
             if isinstance(srx, tuple):
                 srx_list = list(srx)
             else:
-                srx_list.append(srx)
+                # fire hands over 'SRX1,SRX2' as a tuple, a plain string reaches here from python or main()
+                srx_list = [accession.strip() for accession in str(srx).split(',')]
 
         columns = switcher.get(sa_lcp, 'study_abstract, library_construction_protocol')
-        query = SQL_dict['srx_sa_lcp'].format(columns)
+
+        # fetch the experiments a batch at a time, then report them in the order they were given
+        rows = {}
+        unique_srx = list(dict.fromkeys(srx_list))
+        for i in range(0, len(unique_srx), MAX_SQL_VARIABLES):
+            batch = unique_srx[i:i + MAX_SQL_VARIABLES]
+            query = SQL_dict['srx_sa_lcp'].format(columns, ','.join('?' * len(batch)))
+            for r in self.cursor.execute(query, batch):
+                rows.setdefault(r[0], []).append(r[1:])
 
         for experiment in srx_list:
-            results = self.cursor.execute(query, (experiment,)).fetchall()
-            for r in results:
+            for r in rows.get(experiment, []):
                 if sa_lcp == 'sa' or sa_lcp == 'lcp':
                     results_final.append(r[0])
                 else:
@@ -266,8 +779,8 @@ class SRAMetadataX(object):
         if not results_final:
             print('Experiment {} contains no study abstract and/or library construction protocol data'.format(srx))
 
-        for result in results_final:
-            print(result + '\n')
+        # one buffered write instead of a print call per result
+        sys.stdout.writelines(result + '\n\n' for result in results_final)
 
 
     def table_info(self, command: str = 'list_all'):
@@ -286,13 +799,17 @@ class SRAMetadataX(object):
         return results
 
 
-    def terms(self, terms, output: str = 'run_accession', save = False, print_out = True):
+    def terms(self, terms, output: str = 'run_accession', save = False, print_out = True, fts: bool = False):
         """
         Search for submissions in the metadb that contain ALL provided terms. Run 'cli.py terms -h' for documentation \n
         The experiment columns searched are 'title', 'study_name', 'design_description', \n
         'sample_name', 'library_strategy', 'library_construction_protocol', 'platform', \n
         'instrument_model', and 'platform_parameters'. \n
-        The study column searched is 'study_abstract'.
+        The study column searched is 'study_abstract'. \n
+        Each term matches anywhere inside a single column, case-insensitively, so 'NA1287' finds NA12878. \n
+        With --fts, terms are looked up in the full text index built by 'cli.py ensure_fts' instead: they \n
+        match whole words, compared by their porter stem ('sequencing' finds 'sequenced'), and 'NA1287' \n
+        no longer finds NA12878.
         :param terms: term(s) to search for separated by commas. ex: 'NA12878, Illumina platform, \n
         reagent'. Alternatively, enter the path to a text file of term groups to search for.
         :param output: OPTIONAL: by default run_accessions are outputted. Enter 'experiment_accession', \n
@@ -300,70 +817,168 @@ class SRAMetadataX(object):
         'experiment_accession, run_accession'.
         :param save: OPTIONAL: pass argument 'True' to save accessions to a temporary 'terms' table.
         :param print_out: internal use only.
+        :param fts: OPTIONAL: pass argument 'True' to search the full text index, much faster on the full SRAdb.
         :return: run or both study and run accession numbers for entries containing the terms
         """
+        if fts and not self._has_fts():
+            print("Error: no full text index found, run 'cli.py ensure_fts' first or search without --fts")
+            return
+        groups = self._term_groups(terms)
+        return self._terms_helper(groups, output, save, print_out, groups[0] if len(groups) == 1 else terms, fts)
+
 
+    def _term_groups(self, terms):
+        """
+        Terms parser helper function. Method name is preceded by underscore to hide from user.
+        Returns the term groups to search for: one per non-empty line of a terms file, otherwise just one.
+        """
         if os.path.isfile(str(terms)):
+            # read the whole file up front, one comma separated term group per line
             with open(terms, 'r') as f:
-                for line in f:
-                    terms_list = []
-                    for keyword in line.split(','):
-                        terms_list.append(keyword.rstrip("\n"))
-                    self._terms_helper(terms_list, output, save, print_out)
-        else:
-            if isinstance(terms, tuple):
-                terms = list(terms)
+                return [[t.strip() for t in line.split(',')] for line in f.read().splitlines() if line.strip()]
+        if isinstance(terms, tuple):
+            return [list(terms)]
+        # fire passes comma separated terms containing spaces as one plain string
+        if isinstance(terms, str):
+            return [[t.strip() for t in terms.split(',')]]
+        return [terms]
 
-            return self._terms_helper(terms, output, save, print_out)
 
-
-    def _terms_helper(self, terms, output: str = 'run_accession', save = False, print_out = True):
+    def _term_conditions(self, terms, fts):
         """
-        Terms helper function. Method name is preceded by underscore to hide from user.
+        Terms condition helper function. Method name is preceded by underscore to hide from user.
+        Returns the WHERE condition on the sra table matching rows that contain all terms, and its parameters. \n
+        fts selects the full text index over LIKE.
         """
-        
-        columns = ['experiment_title', 'study_name', 'design_description', 'sample_name', 'library_strategy', 
-                   'library_construction_protocol', 'platform', 'instrument_model', 'platform_parameters', 'study_abstract']
+        # an empty term, e.g. from a trailing comma, matches every row with LIKE but no row in the index
+        terms = [t for t in terms if t.strip()] or terms
+        fts = fts and any(t.strip() for t in terms)
+        if fts:
+            # each term is matched as a quoted phrase so multi-word terms stay together
+            params = [' AND '.join('"' + t.strip().replace('"', '""') + '"' for t in terms)]
+        elif len(terms) >= MATCH_ALL_MIN_TERMS:
+            params = [MATCH_ALL_SEP.join(terms)]
+        else:
+            # match %, _ and backslashes in a term literally rather than as LIKE wildcards
+            params = ['%' + t.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_') + '%' for t in terms]
+        return self._terms_where(len(terms), fts), params
 
-        # if output == 'srr':
-        #     query_string = 'SELECT DISTINCT run_accession FROM sra WHERE ('
-        # else:
-        #     query_string = 'SELECT DISTINCT study_accession, run_accession FROM sra WHERE ('
 
-        query_string = 'SELECT DISTINCT ' + output + ' FROM sra WHERE ('
+    def _term_batches(self, groups, fts = False):
+        """
+        Terms batch helper function. Method name is preceded by underscore to hide from user.
+        ORs term groups together into as few conditions as SQLite's variable limit allows, yielding \n
+        each combined condition with its parameters. fts selects the full text index over LIKE.
+        """
+        conditions, params = [], []
+        for group in groups:
+            condition, group_params = self._term_conditions(group, fts)
+            if conditions and (len(params) + len(group_params) > MAX_SQL_VARIABLES or
+                               len(conditions) == TERMS_BATCH_GROUPS):
+                yield ' OR '.join(conditions), params
+                conditions, params = [], []
+            conditions.append('(' + condition + ')')
+            params.extend(group_params)
+        if conditions:
+            yield ' OR '.join(conditions), params
+
+
+    def _terms_helper(self, groups, output: str = 'run_accession', save = False, print_out = True, terms = None, fts = False):
+        """
+        Terms helper function. Method name is preceded by underscore to hide from user.
+        Searches for rows matching any of the term groups, which are ORed together in batches.
+        """
         output_count = output.count(',') + 1
 
         if output_count > 3: 
             print('Error: limit output to experiment_accession, run_accession, and/or study_accession only')
             return
 
-        for t in terms:
-            for c in columns:
-                query_string += c + ' LIKE "%' + t + '%" OR '
-            query_string = query_string[:-4]
-            query_string += ') AND ('
+        batches = list(self._term_batches(groups, fts))
+        # rows are only repeated when they match groups from different batches
+        seen = set() if len(batches) > 1 else None
+        results = []
+        found = False
+        for conditions, params in batches:
+            cursor = self.db.execute(SQL_dict['terms'].format(output, conditions), params)
+            rows = cursor.fetchmany(TERMS_CHUNK_SIZE)
+            while rows:
+                if seen is not None:
+                    rows = [r for r in rows if r not in seen]
+                    seen.update(rows)
+                found = found or bool(rows)
+                if print_out:
+                    # hand each chunk of rows to a single writelines call
+                    sys.stdout.writelines(', '.join(c or '' for c in r) + '\n' for r in rows)
+                else:
+                    results.extend(rows)
+                rows = cursor.fetchmany(TERMS_CHUNK_SIZE)
 
-        query_string = query_string[:-6]
+        if not found:
+            print('No submissions match all of the provided terms: {}'.format(terms if terms is not None else groups))
+        elif not print_out:
+            return results
 
-        results = self.cursor.execute(query_string).fetchall()
-        if not results:
-            print('No submissions match all of the provided terms: {}'.format(terms))
-        else:
-            if print_out:
-                for r in results:
-                    #results is a list of tuples
-                    if output_count == 1:
-                        print(r[0])
-                    elif output_count == 2:
-                        print(r[0] + ', ' + r[1])
-                    else:
-                        print(r[0] + ', ' + r[1] + ', ' + r[2])
-            else:
-                return results
+    @staticmethod
+    @functools.lru_cache(maxsize=64)
+    def _terms_where(n_terms, fts):
+        """
+        Terms condition builder. Method name is preceded by underscore to hide from user.
+        The condition only depends on the number of terms, so it is built once per shape.
+        """
+        if fts:
+            return SQL_dict['terms_fts']
+        # every term has to appear somewhere in the same row
+        if n_terms >= MATCH_ALL_MIN_TERMS:
+            return 'match_all(' + TERMS_EXPR + ', ?)'
+        return ' AND '.join([TERMS_LIKE] * n_terms)
 
     # def test(self, terms):
     #     terms = list(terms)
     #     print(terms)
 
-if __name__ == "__main__":
+# commands main() runs without fire, with their arguments in positional order. They print their own
+# results, so nothing is lost by not going through fire's formatting of return values
+FAST_COMMANDS = {'terms': ['terms', 'output', 'save'],
+                 'keyword_match': ['experiments_file', 'keyword_file', 'save'],
+                 'srx_sa_lcp': ['srx', 'sa_lcp']}
+
+# parameters of those commands that main() only accepts as flags
+FAST_FLAGS = {'terms': ['fts']}
+
+
+def main(argv=None):
+    """
+    Entry point. The common commands are parsed with argparse and called directly, which skips fire's \n
+    introspection of the whole class on every invocation; everything else, including --help, goes to fire.
+    """
+    import argparse
+
+    argv = sys.argv[1:] if argv is None else argv
+    # fire's own flags come after a '--', leave those invocations to fire
+    if argv and argv[0] in FAST_COMMANDS and not {'-h', '--help', '--'} & set(argv):
+        params = FAST_COMMANDS[argv[0]]
+        parser = argparse.ArgumentParser(prog=argv[0], add_help=False, allow_abbrev=False)
+        parser.add_argument('positional', nargs='*')
+        for param in params + FAST_FLAGS.get(argv[0], []):
+            parser.add_argument('--' + param, nargs='?', const=True, default=argparse.SUPPRESS)
+        args, unknown = parser.parse_known_args(argv[1:])
+        kwargs = vars(args)
+        positional = kwargs.pop('positional')
+        # like fire, read True and False as booleans
+        kwargs = {k: {'True': True, 'False': False}.get(v, v) if isinstance(v, str) else v for k, v in kwargs.items()}
+        # values for any parameter not given as a flag, in order
+        free = [param for param in params if param not in kwargs]
+        if not unknown and len(positional) <= len(free) and not any(p.startswith('-') for p in positional):
+            kwargs.update(zip(free, positional))
+            if params[0] in kwargs:
+                getattr(SRAMetadataX(), argv[0])(**kwargs)
+                return
+
+    import fire
+
     fire.Fire(SRAMetadataX)
+
+
+if __name__ == "__main__":
+    main()